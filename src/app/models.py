@@ -17,8 +17,8 @@ class Paste(Model):
             self.logger.debug("Date is missing: nothing to normalize")
             return
 
-        date_object = datetime.datetime.strptime(original_date, self.context.config.DB_DT_INPUT_FORMAT)
-        self.date = date_object.strftime(self.context.config.DB_DT_DB_FORMAT)
+        # formatting for the database is left to the sqlite3 date adapter
+        self.date = datetime.datetime.strptime(original_date, self.context.config.DB_DT_INPUT_FORMAT)
         self.logger.debug("Date %s normalized to %s", original_date, self.date)
 
     def __normalize__author(self):
@@ -1,3 +1,4 @@
+import datetime
 import time
 
 from app.models import Paste
@@ -15,7 +16,8 @@ class Runner(Base):
         self.model_collection = ModelCollection(context, model=Paste)
 
     def _is_the_paste_new(self, paste, latest_paste):
-        if paste.date < latest_paste.date:
+        # dates which could not be parsed are kept as text and cannot be ordered
+        if isinstance(paste.date, datetime.datetime) and isinstance(latest_paste.date, datetime.datetime) and paste.date < latest_paste.date:
             return False
         if paste == latest_paste:
             return False
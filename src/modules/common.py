@@ -36,6 +36,10 @@ class Config:
         self.DB_DT_DB_FORMAT = self.config[section].get('date_db_format')
         self.DB_UNKNOWN_AUTHOR_NAME_VARIATIONS = self.config[section].get('unknown_author_name_variations')
         self.DB_UNKNOWN_AUTHOR_DB_NAME = self.config[section].get('unknown_author_db_name')
+        self.DB_JOURNAL_MODE = self.config[section].get('journal_mode')
+        self.DB_SYNCHRONOUS = self.config[section].get('synchronous')
+        self.DB_TEMP_STORE = self.config[section].get('temp_store')
+        self.DB_CACHE_SIZE = self.config[section].get('cache_size')
 
     def _init_tor_section(self):
         section = 'tor'
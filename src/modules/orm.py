@@ -1,62 +1,158 @@
+import contextlib
+import datetime
+import logging
+import operator
 import sqlite3
 
 from modules.common import Base
 
 
+_registered_date_format = None
+
+
+def register_date_conversions(date_format):
+    """
+    Lets sqlite3 convert datetime objects to and from the database date format.
+    sqlite3 adapters and converters are global to the process:
+    they are registered once and cannot be changed to another format afterwards.
+    """
+    global _registered_date_format
+    if _registered_date_format == date_format:
+        return
+    if _registered_date_format is not None:
+        raise ValueError("sqlite3 date conversions are already registered for the {} format".format(_registered_date_format))
+
+    def convert_date(value):
+        value = value.decode()
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            # keeping values which could not be normalized before being stored as they are
+            return value
+
+    sqlite3.register_adapter(datetime.datetime, lambda value: value.strftime(date_format))
+    sqlite3.register_converter('date', convert_date)
+    _registered_date_format = date_format
+
+
 class SQLiteConnection(Base):
     """
     General class to connect to and query an SQLite database
     """
+    PLACEHOLDER = '?'
+
     def __init__(self, context):
         super().__init__(context)
         self._connection = None
+        self._cursor = None
+        self._in_transaction = False
+        self._log_queries = self.logger.isEnabledFor(logging.DEBUG)
+        register_date_conversions(self.context.config.DB_DT_DB_FORMAT)
 
     @property
     def connection(self):
         if self._connection is None:
-            self._connection = sqlite3.connect(self.context.config.DB_FILEPATH)
+            self._connection = sqlite3.connect(self.context.config.DB_FILEPATH, detect_types=sqlite3.PARSE_DECLTYPES)
+            self._apply_pragmas()
         return self._connection
 
-    def execute(self, query, params=None, many=False, commit=False, close=False):
-        cursor = self.connection.cursor()
-        execute_function = cursor.executemany if many else cursor.execute
-
+    def _apply_pragmas(self):
+        pragmas = [('journal_mode', self.context.config.DB_JOURNAL_MODE),
+                   ('synchronous', self.context.config.DB_SYNCHRONOUS),
+                   ('temp_store', self.context.config.DB_TEMP_STORE),
+                   ('cache_size', self.context.config.DB_CACHE_SIZE)]
+        for pragma_name, pragma_value in pragmas:
+            # leaving the sqlite default in place for settings missing from the configuration
+            if not pragma_value:
+                continue
+            self.logger.debug("Setting PRAGMA %s=%s", pragma_name, pragma_value)
+            self._connection.execute("PRAGMA {}={}".format(pragma_name, pragma_value)).close()
+
+    def _log_query(self, query, params):
         self.logger.debug("Executing query: %s", query)
         if params is not None:
             self.logger.debug("With params: %s", params)
-        else:
-            params = tuple()
-        execute_function(query, params)
 
-        if commit:
+    def _get_cursor(self):
+        if self._cursor is None:
+            self._cursor = self.connection.cursor()
+        return self._cursor
+
+    def execute_one(self, query, params=None, commit=False, close=False):
+        if self._log_queries:
+            self._log_query(query, params)
+        cursor = self.connection.execute(query, tuple() if params is None else params)
+        self._finish_execution(commit, close)
+        return cursor
+
+    def execute_many(self, query, params_list, commit=False, close=False):
+        if self._log_queries:
+            self._log_query(query, params_list)
+        cursor = self.connection.executemany(query, params_list)
+        self._finish_execution(commit, close)
+        return cursor
+
+    execute = execute_one
+
+    def _finish_execution(self, commit, close):
+        if commit and not self._in_transaction:
             self.connection.commit()
         if close:
             self.close()
 
-        return cursor
-
     def execute_fetch_one_record(self, query, params=None):
-        cursor = self.execute(query, params)
-        result = cursor.fetchone()
-        cursor.close()
-        return result
+        if self._log_queries:
+            self._log_query(query, params)
+        return self._get_cursor().execute(query, tuple() if params is None else params).fetchone()
 
     def execute_fetch_single_value(self, query, params=None):
-        cursor = self.execute(query, params)
-        result = cursor.fetchone()
-        cursor.close()
+        result = self.execute_fetch_one_record(query, params)
         return None if not result else result[0]
 
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Runs the statements executed within the block as a single transaction,
+        committing it on success and rolling it back on error.
+        Statements executed with commit=True do not commit on their own inside the block.
+        """
+        if self._in_transaction:
+            # joining the already open transaction
+            yield self
+            return
+
+        self._in_transaction = True
+        try:
+            with self.connection:
+                yield self
+        finally:
+            self._in_transaction = False
+
     @property
     def placeholder(self):
-        return '?'
+        return self.PLACEHOLDER
+
+    @classmethod
+    def placeholders(cls, count):
+        return ', '.join((cls.PLACEHOLDER,) * count)
 
     def close(self):
         if self._connection:
+            self._cursor = None
             self._connection.close()
             self._connection = None
 
 
+def shared_connection(context):
+    """
+    Returns the connection shared by every model and collection using the context
+    """
+    connection = getattr(context, 'db_connection', None)
+    if connection is None:
+        connection = context.db_connection = SQLiteConnection(context)
+    return connection
+
+
 class Model(Base):
     """
     Abstract class representing a single database table.
@@ -79,35 +175,51 @@ class Model(Base):
     """
     NORMALIZATION_PREFIX = '__normalize__'
     ID_KEYWORD = 'pk'
+    FIELDS = None
     ORDER_BY = None
+    # names of the fields to index, the ORDER_BY field is always indexed
+    INDEXED_FIELDS = tuple()
+    _TABLE_NAME = 'tbl_models'
+    _COLUMNS = tuple()
+    _COLUMN_SQL = ''
+    _NORMALIZATIONS = []
 
     def __init__(self, context, **kwargs):
         super().__init__(context)
         self.__id = None
-        self.__columns = None
-        self.__normalizations = None
         self.__method__validate_inheriting_class()
+        self.__method__prepare_statements()
         self.__method__connect()
         self.__method__populate_model_fields(kwargs)
-        self.__method__collect_normalization_methods()
         self.__method__normalize_if_necessary()
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.__method__collect_table_structure()
+        cls.__method__collect_normalization_methods()
+
     def __eq__(self, other):
-        for column in self.__property__columns:
-            if getattr(self, column) != getattr(other, column):
-                return False
-        return True
+        return self.__property__values == other.__property__values
 
     def __str__(self):
-        return ", ".join("{}: {}".format(column, getattr(self, column)) for column in self.__property__columns)
-
-    def __del__(self):
-        self.connection.close()
+        return ", ".join("{}: {}".format(column, value) for column, value in zip(self._COLUMNS, self.__property__values))
 
     @classmethod
     def get_table_name(cls):
-        model_name = cls.__name__.lower()
-        return 'tbl_{}{}'.format(model_name, '' if model_name.endswith('s') else 's')
+        return cls._TABLE_NAME
+
+    @classmethod
+    def from_row(cls, context, row):
+        """
+        Builds a model instance out of an (id, *columns) record without querying or normalizing it
+        """
+        instance = cls.__new__(cls)
+        Base.__init__(instance, context)
+        instance.__id = row[0]
+        instance.__method__prepare_statements()
+        instance.__method__connect()
+        instance.__dict__.update(zip(cls._COLUMNS, row[1:]))
+        return instance
 
     @classmethod
     def create_table_if_necessary(cls, context):
@@ -116,29 +228,59 @@ class Model(Base):
 
     @property
     def __property__columns(self):
-        if not self.__columns:
-            self.__columns = [field_name for field_name, _ in self.FIELDS]
-        return self.__columns
+        return self._COLUMNS
 
     @property
     def __property__values(self):
-        return [getattr(self, field_name) for field_name, _ in self.FIELDS]
+        return self._VALUES_GETTER(self)
+
+    def __method__prepare_statements(self):
+        model_class = type(self)
+        id_field = self.context.config.DB_ID_FIELD
+        if model_class.__dict__.get('_STATEMENTS_ID_FIELD') == id_field:
+            return
+
+        self.logger.debug("Preparing %s statements", model_class.__name__)
+        table_name = self._TABLE_NAME
+        columns = self._COLUMN_SQL
+        value_placeholders = ', '.join("{}={}".format(field_name, SQLiteConnection.PLACEHOLDER) for field_name in self._COLUMNS)
+        model_class._UPDATE_SQL = "UPDATE {} SET {} WHERE {}={}".format(table_name, value_placeholders, id_field, SQLiteConnection.PLACEHOLDER)
+        model_class._DELETE_SQL = "DELETE FROM {} WHERE {}={}".format(table_name, id_field, SQLiteConnection.PLACEHOLDER)
+        model_class._SELECT_BY_ID_SQL = "SELECT {} FROM {} WHERE {}={}".format(columns, table_name, id_field, SQLiteConnection.PLACEHOLDER)
+        model_class._STATEMENTS_ID_FIELD = id_field
 
     def __method__connect(self):
-        self.connection = SQLiteConnection(self.context)
+        self.connection = shared_connection(self.context)
 
     def __method__validate_inheriting_class(self):
         if not self.FIELDS:
             raise NotImplementedError("Inheriting class must provide the FIELDS structure!")
 
-    def __method__collect_normalization_methods(self):
-        self.logger.debug("Collecting normalization methods")
-        self.__normalizations = [getattr(self, method)
-                                 for method
-                                 in dir(self)
-                                 if callable(getattr(self, method))
-                                 and getattr(self, method).__name__.startswith(self.NORMALIZATION_PREFIX)]
-        self.logger.debug("Collected: %s", self.__normalizations)
+    @classmethod
+    def __method__collect_table_structure(cls):
+        model_name = cls.__name__.lower()
+        cls._TABLE_NAME = 'tbl_{}{}'.format(model_name, '' if model_name.endswith('s') else 's')
+        cls._COLUMNS = tuple(field_name for field_name, _ in cls.FIELDS or ())
+        cls._COLUMN_SQL = ', '.join(cls._COLUMNS)
+        cls._INSERT_SQL = "INSERT INTO {} ({}) VALUES ({})".format(cls._TABLE_NAME,
+                                                                   cls._COLUMN_SQL,
+                                                                   SQLiteConnection.placeholders(len(cls._COLUMNS)))
+        if len(cls._COLUMNS) > 1:
+            cls._VALUES_GETTER = operator.attrgetter(*cls._COLUMNS)
+        elif cls._COLUMNS:
+            # attrgetter returns a bare value rather than a tuple for a single field
+            value_getter = operator.attrgetter(cls._COLUMNS[0])
+            cls._VALUES_GETTER = staticmethod(lambda instance: (value_getter(instance),))
+
+    @classmethod
+    def __method__collect_normalization_methods(cls):
+        # attribute names are mangled by the inheriting class, hence matching on the function name
+        normalizations = dict()
+        for klass in reversed(cls.__mro__):
+            for attribute in vars(klass).values():
+                if callable(attribute) and getattr(attribute, '__name__', '').startswith(cls.NORMALIZATION_PREFIX):
+                    normalizations[attribute.__name__] = attribute
+        cls._NORMALIZATIONS = [normalizations[name] for name in sorted(normalizations)]
 
     def __method__get_database_field_type(self, field_type):
         database_field_type = 'text'
@@ -149,8 +291,8 @@ class Model(Base):
         return database_field_type
 
     def __method__create_table(self, table_name):
-        self.logger.debug("Creating table %s", table_name)
-        query_parts = ["CREATE TABLE {} ".format(table_name)]
+        self.logger.debug("Creating table %s if necessary", table_name)
+        query_parts = ["CREATE TABLE IF NOT EXISTS {} ".format(table_name)]
         query_parts.append("(")
         columns = ["{} integer primary key".format(self.context.config.DB_ID_FIELD)]
         for field_name, field_type in self.FIELDS:
@@ -160,15 +302,19 @@ class Model(Base):
         self.connection.execute(query="".join(query_parts), commit=True)
 
     def __method__create_table_if_necessary(self):
-        self.logger.debug("Checking whether table %s has to be created", self.get_table_name())
-        if self.connection.execute_fetch_single_value("SELECT name "
-                                                      "FROM sqlite_master "
-                                                      "WHERE type={placeholder} "
-                                                      "AND name={placeholder}".format(placeholder=self.connection.placeholder),
-                                                      ('table', self.get_table_name())):
-            self.logger.debug("Table %s already exists", self.get_table_name())
-        else:
-            self.__method__create_table(self.get_table_name())
+        self.__method__create_table(self.get_table_name())
+        self.__method__create_indexes(self.get_table_name())
+
+    def __method__create_indexes(self, table_name):
+        indexed_fields = list(self.INDEXED_FIELDS)
+        if self.ORDER_BY and self.ORDER_BY not in indexed_fields:
+            indexed_fields.append(self.ORDER_BY)
+        for field_name in indexed_fields:
+            if field_name not in self.__property__columns:
+                raise AttributeError("Invalid indexed field: {}".format(field_name))
+            self.logger.debug("Creating index on %s.%s if necessary", table_name, field_name)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS idx_{0}_{1} ON {0} ({1})".format(table_name, field_name),
+                                    commit=True)
 
     def __method__populate_model_fields(self, kwargs):
         # creating a new model instance in case id is not provided
@@ -179,12 +325,7 @@ class Model(Base):
 
         # retrieving the record otherwise
         if self.ID_KEYWORD in kwargs:
-            record = self.connection.execute_fetch_one_record("SELECT {} "
-                                                              "FROM {} "
-                                                              "WHERE {}={}".format(', '.join(self.__property__columns),
-                                                                                   self.get_table_name(),
-                                                                                   self.context.config.DB_ID_FIELD,
-                                                                                   kwargs[self.ID_KEYWORD]))
+            record = self.connection.execute_fetch_one_record(self._SELECT_BY_ID_SQL, (kwargs[self.ID_KEYWORD],))
             if not record:
                 raise ValueError("No {} record found with {} = {}".format(type(self).__name__, self.context.config.DB_ID_FIELD, kwargs[self.ID_KEYWORD]))
             record_dict = dict(zip(self.__property__columns, record))
@@ -199,22 +340,16 @@ class Model(Base):
             self.logger.debug("Normalization not needed")
             return
 
-        for normalization_method in self.__normalizations:
+        for normalization_method in self._NORMALIZATIONS:
             try:
-                normalization_method()
+                normalization_method(self)
             except Exception as e:
                 self.logger.error("%s failed: %s", normalization_method.__name__, e)
 
     def __method__update(self):
         self.logger.debug("Updating a %s record", type(self).__name__)
-        value_placeholders = ', '.join("{}={}".format(field_name, self.connection.placeholder) for field_name in self.__property__columns)
-        self.connection.execute("UPDATE {} "
-                                "SET {} "
-                                "WHERE {}={}".format(self.get_table_name(),
-                                                     value_placeholders,
-                                                     self.context.config.DB_ID_FIELD,
-                                                     self.__id),
-                                tuple(self.__property__values),
+        self.connection.execute(self._UPDATE_SQL,
+                                self.__property__values + (self.__id,),
                                 commit=True)
 
     def save(self):
@@ -226,21 +361,15 @@ class Model(Base):
             return
 
         self.logger.debug("Storing a %s record", type(self).__name__)
-        placeholders = ('{}, '.format(self.connection.placeholder) * len(self.FIELDS)).strip(', ')
-        self.connection.execute("INSERT INTO {} ({}) VALUES ({})".format(self.get_table_name(),
-                                                                         ', '.join(self.__property__columns),
-                                                                         placeholders),
-                                tuple(self.__property__values),
-                                commit=True)
-        self.__id = self.connection.execute_fetch_single_value("SELECT last_insert_rowid()")
+        cursor = self.connection.execute(self._INSERT_SQL,
+                                         self.__property__values,
+                                         commit=True)
+        self.__id = cursor.lastrowid
+        cursor.close()
 
     def delete(self):
         self.logger.debug("Deleting a %s record", type(self).__name__)
-        self.connection.execute("DELETE FROM {} "
-                                "WHERE {}={}".format(self.get_table_name(),
-                                                     self.context.config.DB_ID_FIELD,
-                                                     self.__id),
-                                commit=True)
+        self.connection.execute(self._DELETE_SQL, (self.__id,), commit=True)
 
 
 class ModelCollection(Base):
@@ -250,30 +379,52 @@ class ModelCollection(Base):
     def __init__(self, context, model):
         super().__init__(context)
         self.model = model
-        self.connection = SQLiteConnection(self.context)
+        self.connection = shared_connection(self.context)
+        self._prepare_statements()
+
+    def _prepare_statements(self):
+        self._latest_id_query = "SELECT {} FROM {} ORDER BY {} DESC LIMIT 1".format(self.context.config.DB_ID_FIELD,
+                                                                                    self.model.get_table_name(),
+                                                                                    self.model.ORDER_BY)
+        self._all_records_query = "SELECT {}, {} FROM {} ORDER BY {}".format(self.context.config.DB_ID_FIELD,
+                                                                             self.model._COLUMN_SQL,
+                                                                             self.model.get_table_name(),
+                                                                             self.context.config.DB_ID_FIELD)
 
     def get_the_most_recent(self):
         self.logger.debug("Retrieving the most recent model instance")
-        latest_id = self.connection.execute_fetch_single_value("SELECT {} "
-                                                               "FROM {} "
-                                                               "ORDER BY {} DESC "
-                                                               "LIMIT 1".format(self.context.config.DB_ID_FIELD,
-                                                                                self.model.get_table_name(),
-                                                                                self.model.ORDER_BY))
+        latest_id = self.connection.execute_fetch_single_value(self._latest_id_query)
         if not latest_id:
             return None
 
         model_object = self.model(self.context, pk=latest_id)
         return model_object
 
+    def iter_all(self, batch_size=1000):
+        """
+        Yields every stored model instance, fetching the records batch_size at a time
+        """
+        self.logger.debug("Iterating over all %s records", self.model.__name__)
+        cursor = self.connection.execute(self._all_records_query)
+        try:
+            while True:
+                records = cursor.fetchmany(batch_size)
+                if not records:
+                    break
+                for record in records:
+                    yield self.model.from_row(self.context, record)
+        finally:
+            cursor.close()
+
+    def save_many(self, model_list):
+        """
+        Stores the model instances as new records using a single transaction
+        """
+        self.logger.debug("Storing %s %s records", len(model_list), self.model.__name__)
+        values = [self.model._VALUES_GETTER(model_instance) for model_instance in model_list]
+        with self.connection.transaction():
+            self.connection.execute_many(self.model._INSERT_SQL, values).close()
+
     def store(self, model_list):
         self.logger.debug("Storing the list of model instances")
-        placeholders = ('{}, '.format(self.connection.placeholder) * len(self.model.FIELDS)).strip(', ')
-        columns = [field_name for field_name, _ in self.model.FIELDS]
-        values = [tuple(getattr(model_instance, column) for column in columns) for model_instance in model_list]
-        self.connection.execute("INSERT INTO {} ({}) VALUES ({})".format(self.model.get_table_name(),
-                                                                         ', '.join(columns),
-                                                                         placeholders),
-                                values,
-                                many=True,
-                                commit=True)
+        self.save_many(model_list)